@@ -31,25 +31,29 @@ Known issues:
 
 """
 
-from math import ceil
+from math import ceil, sqrt, inf
+from statistics import median
 from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
 
 import pyxel
 import click
 
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Vec2:
     x: float = 0
     y: float = 0
 
-@dataclass
+@dataclass(slots=True, eq=False)
 class Rect:
     x: float = 0
     y: float = 0
     w: float = 0
     h: float = 0
 
+    is_dynamic = False
+
     @property
     def r(self):
         return self.x + self.w
@@ -67,34 +71,100 @@ class Rect:
         self.x, self.y = value.x, value.y
 
 
-class Static(Rect): pass
+@dataclass(slots=True, eq=False)
+class Static(Rect):
+    # statics don't move, so their right/bottom edges are computed only once
+    r: float = field(init=False, repr=False)
+    b: float = field(init=False, repr=False)
 
-@dataclass
+    def __post_init__(self):
+        self.r = self.x + self.w
+        self.b = self.y + self.h
+
+@dataclass(slots=True, eq=False)
 class Dynamic(Rect):
-    velocity: Vec2 = field(default_factory=Vec2)
-    old_position: Vec2 = field(default_factory=Vec2)
+    is_dynamic = True
+
+    vx: float = 0
+    vy: float = 0
     had_collision: bool = False
 
+    # the (steps, length_squared) pair from get_sweep_steps() only depends
+    # on velocity and gravity; cached between frames, since these often
+    # don't change
+    _sweep_key: tuple = field(default_factory=tuple, init=False, repr=False)
+    _sweep: tuple = field(default_factory=tuple, init=False, repr=False)
 
-@dataclass
+
+# the most grid cells along either axis of a world
+GRID_MAX_CELLS = 64
+
+
+@dataclass(slots=True)
 class World:
     things: list = field(default_factory=list)
-    gravity: Vec2 = field(default_factory=lambda: Vec2(0, 1))
+    gx: float = 0
+    gy: float = 1
+
+    # derived from things in __post_init__
+    _statics: list = field(init=False, repr=False, compare=False)
+    _dynamics: list = field(init=False, repr=False, compare=False)
+    _statics_bbox: list = field(init=False, repr=False, compare=False)
+    _statics_bounds: tuple = field(init=False, repr=False, compare=False)
+    _cell_size: float = field(init=False, repr=False, compare=False)
+    _grid: dict = field(init=False, repr=False, compare=False)
+    _grid_extent: tuple = field(init=False, repr=False, compare=False)
 
     def __post_init__(self):
         self.things = list(self.things)
+        self._statics = [one for one in self.things if not one.is_dynamic]
+        self._dynamics = [one for one in self.things if one.is_dynamic]
+        self._statics_bbox = [(one.x, one.r, one.y, one.b) for one in self._statics]
+        # the box around all the statics; nothing outside it can collide
+        self._statics_bounds = (
+            min((x for x, _, _, _ in self._statics_bbox), default=inf),
+            max((r for _, r, _, _ in self._statics_bbox), default=-inf),
+            min((y for _, _, y, _ in self._statics_bbox), default=inf),
+            max((b for _, _, _, b in self._statics_bbox), default=-inf),
+        )
+        self._build_grid()
+
+    def _build_grid(self):
+        # uniform grid broad phase; a cell is as big as the median static
+        # thickness, so big statics (e.g. merged runs of tiles) span several
+        # cells, and a single very thin or very big static can't set it;
+        # at most GRID_MAX_CELLS cells per axis, however thin the statics
+        if self._statics:
+            bx, br, by, bb = self._statics_bounds
+            self._cell_size = max(
+                median(min(one.w, one.h) for one in self._statics),
+                max(br - bx, bb - by) / GRID_MAX_CELLS,
+            ) or 16
+            cs = self._cell_size
+            self._grid_extent = (
+                int(bx // cs), int(br // cs), int(by // cs), int(bb // cs))
+        else:
+            self._cell_size = 16
+            self._grid_extent = (0, -1, 0, -1)
+
+        cs = self._cell_size
+        gx0, gx1, gy0, gy1 = self._grid_extent
+        grid = {}
+        for bbox in self._statics_bbox:
+            sx, sr, sy, sb = bbox
+            for cx in range(max(int(sx // cs), gx0), min(int(sr // cs), gx1) + 1):
+                for cy in range(max(int(sy // cs), gy0), min(int(sb // cs), gy1) + 1):
+                    grid.setdefault((cx, cy), []).append(bbox)
+        # statics are fixed for the lifetime of the world
+        self._grid = {cell: tuple(bboxes) for cell, bboxes in grid.items()}
 
     @property
     def static_things(self):
-        for one in self.things:
-            if not hasattr(one, 'velocity'):
-                yield one
+        return self._statics
 
     @property
     def dynamic_things(self):
-        for one in self.things:
-            if hasattr(one, 'velocity'):
-                yield one
+        return self._dynamics
 
     @classmethod
     def check_collision(cls, one, two):
@@ -105,68 +175,180 @@ class World:
         return False
 
     def check_dynamic_static_collision(self, one):
-        assert hasattr(one, 'velocity')
-        for two in self.static_things:
-            if self.check_collision(one, two):
-                return True
-        return False
+        hit = self.check_box_collision(
+            one.x, one.x + one.w, one.y, one.y + one.h)
+        return hit is not None
+
+    def check_box_collision(self, ox, or_, oy, ob):
+        """Check if the (x, r, y, b) box collides with any static.
+
+        Return the (x, r, y, b) of the first static hit, or None.
+
+        """
+        bx, br, by, bb = self._statics_bounds
+        if ox >= br or or_ <= bx or oy >= bb or ob <= by:
+            return None
+
+        cs = self._cell_size
+        grid = self._grid
+        # there are no statics outside the grid, so don't look there
+        gx0, gx1, gy0, gy1 = self._grid_extent
+        cx0, cx1 = max(int(ox // cs), gx0), min(int(or_ // cs), gx1)
+        cy0, cy1 = max(int(oy // cs), gy0), min(int(ob // cs), gy1)
+
+        # most of the time the box fits in a single cell
+        if cx0 == cx1 and cy0 == cy1:
+            for sx, sr, sy, sb in grid.get((cx0, cy0), ()):
+                if ox < sr and or_ > sx and oy < sb and ob > sy:
+                    return sx, sr, sy, sb
+            return None
+
+        # a static spanning several cells may get tested more than once;
+        # that's cheaper than keeping track of which ones were seen
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                for sx, sr, sy, sb in grid.get((cx, cy), ()):
+                    if ox < sr and or_ > sx and oy < sb and ob > sy:
+                        return sx, sr, sy, sb
+        return None
 
     def simulate(self, steps_per_frame=1, sweep=True):
-        for one in self.dynamic_things:
-            self.simulate_one(one, steps_per_frame, sweep)
+        simulate_one = self.simulate_one
+        for one in self._dynamics:
+            simulate_one(one, steps_per_frame, sweep)
 
     def simulate_one(self, one, steps_per_frame, sweep):
         sweep_steps = 1
 
         if sweep:
-            new_x = one.x + one.velocity.x + self.gravity.x
-            new_y = one.y + one.velocity.y + self.gravity.y
-            length = ((one.x - new_x) ** 2 + (one.y - new_y) ** 2) ** .5
-            # hardcoded to half of the smallest dimension, could be better
-            sweep_length = min(one.w, one.h) / 2
-            sweep_steps = ceil(length / sweep_length)
+            key = (one.vx, one.vy, self.gx, self.gy)
+            if key != one._sweep_key:
+                one._sweep_key = key
+                one._sweep = self.get_sweep_steps(one)
+            sweep_steps, length_squared = one._sweep
+
+        if not self.check_swept_collision(one):
+            self.simulate_one_free(one, steps_per_frame * sweep_steps)
+            return
 
-        dummy = Dynamic(one.x, one.y, one.w, one.h, Vec2(one.velocity.x, one.velocity.y))
+        dummy = Dynamic(one.x, one.y, one.w, one.h, one.vx, one.vy)
 
         self.simulate_one_step(dummy,  steps_per_frame * sweep_steps)
 
         if sweep and dummy.had_collision:
-            # hardcoded to half a pixel, could be better
-            sweep_length = .5
-            sweep_steps = ceil(length / sweep_length)
-            self.simulate_one_step(one, steps_per_frame * sweep_steps)
+            fine_sweep_steps = self.get_fine_sweep_steps(length_squared)
+            self.simulate_one_step(one, steps_per_frame * fine_sweep_steps)
         else:
-            one.position = dummy.position
-            one.velocity = dummy.velocity
+            one.x, one.y = dummy.x, dummy.y
+            one.vx, one.vy = dummy.vx, dummy.vy
             one.had_collision = dummy.had_collision
 
+    def get_sweep_steps(self, one):
+        """Get the sweep step count for one's movement during the next frame.
+
+        Return a (steps, length_squared) pair; the squared length is
+        passed to get_fine_sweep_steps() if the sweep finds a collision.
+
+        """
+        dx = one.vx + self.gx
+        dy = one.vy + self.gy
+        # compare squared lengths, so we only need sqrt() when sweeping
+        length_squared = dx * dx + dy * dy
+        # hardcoded to half of the smallest dimension, could be better
+        sweep_length = min(one.w, one.h) / 2
+        if length_squared > sweep_length * sweep_length:
+            sweep_steps = ceil(sqrt(length_squared) / sweep_length)
+        elif length_squared:
+            sweep_steps = 1
+        else:
+            sweep_steps = 0
+        return sweep_steps, length_squared
+
+    def get_fine_sweep_steps(self, length_squared):
+        """Get the step count to re-sweep with after a collision."""
+        # hardcoded to half a pixel, could be better
+        return ceil(sqrt(length_squared) / .5)
+
+    def check_swept_collision(self, one):
+        """Check if one could collide with any static during the next frame.
+
+        Whatever the number of substeps, the displacement on each axis
+        stays between 0, velocity, and velocity + gravity, so a box
+        covering all of those covers the whole path.
+
+        """
+        vx, vy = one.vx, one.vy
+        gx, gy = self.gx, self.gy
+        x, y = one.x, one.y
+        # pad a bit, so rounding errors in the substeps can't sneak past
+        pad = 1e-6
+        hit = self.check_box_collision(
+            x + min(0, vx, vx + gx) - pad,
+            x + one.w + max(0, vx, vx + gx) + pad,
+            y + min(0, vy, vy + gy) - pad,
+            y + one.h + max(0, vy, vy + gy) + pad,
+        )
+        return hit is not None
+
+    def simulate_one_free(self, one, steps_per_frame):
+        """Like simulate_one_step(), for when there's nothing to collide with.
+
+        With nothing in the way, the substeps can be summed up:
+        after n substeps of 1/n, the velocity grows by gravity,
+        and the position by velocity + gravity * (n + 1) / 2n.
+
+        """
+        one.had_collision = False
+        if not steps_per_frame:
+            return
+        gx, gy = self.gx, self.gy
+        vx, vy = one.vx, one.vy
+        factor = (steps_per_frame + 1) / (2 * steps_per_frame)
+        one.x += vx + gx * factor
+        one.y += vy + gy * factor
+        one.vx, one.vy = vx + gx, vy + gy
+
     def simulate_one_step(self, one, steps_per_frame):
-        had_collision = False
+        if not steps_per_frame:
+            return
+        substep = self.simulate_one_substep
+        dt = 1 / steps_per_frame
         for _ in range(steps_per_frame):
-            had_collision = self.simulate_one_substep(one, 1 / steps_per_frame)
-            if had_collision:
+            if substep(one, dt):
                 one.had_collision = True
 
     def simulate_one_substep(self, one, steps):
-        one.old_position = one.position
+        check = self.check_box_collision
+        x, y, w, h = one.x, one.y, one.w, one.h
 
         had_collision = False
 
-        one.velocity.x += self.gravity.x * steps
-        one.velocity.y += self.gravity.y * steps
+        vx = one.vx + self.gx * steps
+        vy = one.vy + self.gy * steps
 
-        one.y += one.velocity.y * steps
-        if self.check_dynamic_static_collision(one):
+        new_y = y + vy * steps
+        hit = check(x, x + w, new_y, new_y + h)
+        if hit:
             had_collision = True
-            one.y = one.old_position.y
-            one.velocity.y = 0
-
-        one.x += one.velocity.x * steps
-        if self.check_dynamic_static_collision(one):
+            vy = 0
+        else:
+            y = new_y
+
+        new_x = x + vx * steps
+        new_r, b = new_x + w, y + h
+        # the static hit on the vertical axis is the likeliest to be
+        # in the way on the horizontal one too, so try it first
+        if hit:
+            sx, sr, sy, sb = hit
+            hit = new_x < sr and new_r > sx and y < sb and b > sy
+        if hit or check(new_x, new_r, y, b):
             had_collision = True
-            one.x = one.old_position.x
-            one.velocity.x = 0
+            vx = 0
+        else:
+            x = new_x
 
+        one.x, one.y = x, y
+        one.vx, one.vy = vx, vy
         return had_collision
 
 
@@ -176,6 +358,18 @@ class Scene:
     offset: Vec2
     world: World
 
+    # the statics' on-screen rects, derived in __post_init__
+    static_rects: list = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.static_rects = [
+            (self.offset.x + round(thing.x),
+             self.offset.y + round(thing.y),
+             round(thing.w),
+             round(thing.h))
+            for thing in self.world.static_things
+        ]
+
 
 SCENES = [
     Scene('normal', Vec2(4, 4), World([
@@ -183,23 +377,23 @@ SCENES = [
         Static(0, 30, 16, 3),
     ])),
     Scene('tunnel', Vec2(34, 4), World([
-        Dynamic(4, 0, 3, 3, velocity=Vec2(0, 2)),
+        Dynamic(4, 0, 3, 3, vy=2),
         Static(0, 30, 16, 3)
     ])),
     Scene('hslide', Vec2(64, 4), World([
-        Dynamic(-2, 20, 3, 3, velocity=Vec2(2, 0)),
+        Dynamic(-2, 20, 3, 3, vx=2),
         Static(0, 30, 16, 3),
     ])),
     Scene('vslide', Vec2(94, 4), World([
-        Dynamic(0, 0, 3, 3, velocity=Vec2(2, 0)),
+        Dynamic(0, 0, 3, 3, vx=2),
         Static(12, 12, 3, 20),
     ])),
     Scene('vsxvel', Vec2(124, 4), World([
         Dynamic(0, 0, 3, 3),
         Static(12, 12, 3, 20),
-    ], Vec2(1, 1))),
+    ], 1, 1)),
     Scene('tnlbig', Vec2(34, 56), World([
-        Dynamic(4, -4, 8, 8, velocity=Vec2(0, 20)),
+        Dynamic(4, -4, 8, 8, vy=20),
         Static(0, 30, 16, 3)
     ])),
 ]
@@ -210,14 +404,23 @@ DO_CLIP = True
 DO_SCENE_FRAME = False
 STEPS_PER_FRAME = 1
 SWEEP = True
+POOL = None
+
+
+def simulate_scene(scene):
+    scene.world.simulate(STEPS_PER_FRAME, SWEEP)
 
 
 def update():
     if pyxel.btnp(pyxel.KEY_Q):
         pyxel.quit()
 
-    for scene in SCENES:
-        scene.world.simulate(STEPS_PER_FRAME, SWEEP)
+    # scenes are independent worlds, so they can be simulated in parallel
+    if POOL:
+        list(POOL.map(simulate_scene, SCENES))
+    else:
+        for scene in SCENES:
+            simulate_scene(scene)
 
 
 def draw():
@@ -251,16 +454,18 @@ def draw():
                 48 + 0 - 1,
             )
 
-        for thing in scene.world.things:
-            if hasattr(thing, 'velocity'):
-                color = 2   # purple
-            else:
-                color = 1   # blue
-            if getattr(thing, 'had_collision', False):
+        for x, y, w, h in scene.static_rects:
+            pyxel.rectb(x, y, w, h, 1)  # blue
+
+        offset_x, offset_y = scene.offset.x, scene.offset.y
+        for thing in scene.world.dynamic_things:
+            if thing.had_collision:
                 color = 8   # red
+            else:
+                color = 2   # purple
 
-            pyxel.rectb(scene.offset.x + round(thing.x),
-                        scene.offset.y + round(thing.y),
+            pyxel.rectb(offset_x + round(thing.x),
+                        offset_y + round(thing.y),
                         round(thing.w),
                         round(thing.h),
                         color)
@@ -272,12 +477,15 @@ def draw():
 @click.option('--sweep/--no-sweep', default=True, show_default=True)
 @click.option('--cls/--no-cls', default=False, show_default=True)
 @click.option('--clip/--no-clip', default=True, show_default=True)
-def main(fps, cls, clip, steps_per_frame, sweep):
-    global DO_CLS, DO_CLIP, STEPS_PER_FRAME, SWEEP
+@click.option('-j', '--jobs', type=int, default=1, show_default=True)
+def main(fps, cls, clip, steps_per_frame, sweep, jobs):
+    global DO_CLS, DO_CLIP, STEPS_PER_FRAME, SWEEP, POOL
     DO_CLS = cls
     DO_CLIP = clip
     STEPS_PER_FRAME = steps_per_frame
     SWEEP = sweep
+    if jobs > 1:
+        POOL = ThreadPoolExecutor(max_workers=jobs)
     pyxel.init(160, 120, fps=fps)
     pyxel.run(update, draw)
 
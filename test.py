@@ -1,62 +1,92 @@
 import itertools
-import abc
 import sys
 from dataclasses import dataclass, field
 
 import pyxel
 
-from physics import Static, Dynamic, World, Vec2
+from physics import Static, Dynamic, World
 
 
-class GraphicsComponent(abc.ABC):
+class GraphicsComponent:
+
+    __slots__ = ()
 
-    @abc.abstractmethod
     def render(self, offset_x, offset_y):
         raise NotImplementedError
 
-class InputComponent(abc.ABC):
+class InputComponent:
+
+    __slots__ = ()
 
-    @abc.abstractmethod
     def process_input(self):
         raise NotImplementedError
 
-class PhysicsComponent(abc.ABC):
+class PhysicsComponent:
 
-    pass
+    __slots__ = ()
 
 
-@dataclass
-class TileGraphicsComponent(GraphicsComponent):
+# the base of all tiles; fill and color are how the tile looks when its
+# map rasterizes it (tiles aren't drawn one by one, see Map.rasterize())
+@dataclass(slots=True)
+class TileStatic(Static):
 
     fill: bool = True
     color: int = 1
 
-    def render(self, offset_x, offset_y):
-        func = pyxel.rect if self.fill else pyxel.rectb
-        func(offset_x + self.x,
-             offset_y + self.y,
-             self.w,
-             self.h,
-             self.color)
-
-@dataclass
-class Tile(TileGraphicsComponent, PhysicsComponent, Static):
+@dataclass(slots=True)
+class Tile(TileStatic, PhysicsComponent):
 
     def to_shadow_tile(self, **kwargs):
         return ShadowTile(x=self.x, y=self.y, w=self.w, h=self.h, **kwargs)
 
 
-@dataclass
-class ShadowTile(TileGraphicsComponent, Static):
+@dataclass(slots=True)
+class ShadowTile(TileStatic):
     pass
 
 
-@dataclass
-class Map:
+# which map is currently drawn in each pyxel image bank
+IMAGE_MAPS = {}
+
+@dataclass(slots=True)
+class Map(GraphicsComponent):
     tiles: list = field(default_factory=list)
     spawn_points: list = field(default_factory=list)
     w: int = 0
     h: int = 0
+    # the pyxel image bank the tiles are drawn into
+    image: int = 0
+
+    def rasterize(self):
+        """Draw the tiles into image rows, one hex color digit per pixel."""
+        # anything past the edge of the image bank would be cut off
+        assert self.w <= 256 and self.h <= 256, \
+            "map too big for an image bank: %ix%i" % (self.w, self.h)
+        rows = [['0'] * self.w for _ in range(self.h)]
+        for tile in self.tiles:
+            color = '%x' % tile.color
+            for y in range(tile.y, tile.b):
+                if tile.fill or y == tile.y or y == tile.b - 1:
+                    rows[y][tile.x:tile.r] = [color] * tile.w
+                else:
+                    rows[y][tile.x] = rows[y][tile.r - 1] = color
+        return [''.join(row) for row in rows]
+
+    def render(self, offset_x, offset_y):
+        # draw all the tiles with a single blit instead of a rect() per tile;
+        # the image only needs updating when a different map is shown
+        if IMAGE_MAPS.get(self.image) is not self:
+            pyxel.image(self.image).set(0, 0, self.rasterize())
+            IMAGE_MAPS[self.image] = self
+
+        # only blit the part of the map that is on-screen
+        u = max(0, int(-offset_x))
+        v = max(0, int(-offset_y))
+        w = min(self.w, int(SCREEN_W - offset_x) + 1) - u
+        h = min(self.h, int(SCREEN_H - offset_y) + 1) - v
+        if w > 0 and h > 0:
+            pyxel.blt(offset_x + u, offset_y + v, self.image, u, v, w, h, 0)
 
 @dataclass
 class MapList:
@@ -99,21 +129,31 @@ def parse_map(string, tile_size):
             width = len(chars)
         else:
             assert len(chars) == width, "wrong width at row %i" % j
+        tile_columns = []
         for i, char in enumerate(chars):
             if char == '.':
                 continue
             elif char == '@':
                 spawn_points.append((i * tile_size, j * tile_size))
             elif char == 't':
-                tiles.append(Tile(
-                    x=i * tile_size,
-                    y=j * tile_size,
-                    w=tile_size,
-                    h=tile_size,
-                ))
+                tile_columns.append(i)
             else:
                 assert False, "unknown tile char: %r" % char
 
+        # merge horizontally adjacent tiles into a single wider tile,
+        # so collisions and drawing scale with runs instead of tiles;
+        # consecutive columns have the same column - index difference
+        runs = itertools.groupby(
+            enumerate(tile_columns), lambda pair: pair[1] - pair[0])
+        for _, run in runs:
+            run = [i for _, i in run]
+            tiles.append(Tile(
+                x=run[0] * tile_size,
+                y=j * tile_size,
+                w=len(run) * tile_size,
+                h=tile_size,
+            ))
+
     height = j + 1
 
     return Map(tiles, spawn_points, width * tile_size, height * tile_size)
@@ -182,6 +222,16 @@ parse_map("""
 
 SCREEN_W, SCREEN_H = 160, 120
 
+# print jump state transitions
+DEBUG = False
+
+
+STANDING, JUMPING, FALLING = range(3)
+JUMP_STATE_NAMES = ('standing', 'jumping', 'falling')
+
+# bits of GuyInputComponent.buttons
+LEFT, RIGHT, JUMP, JUMP_NOW = 1, 2, 4, 8
+
 
 @dataclass
 class GuyInputComponent(InputComponent):
@@ -197,19 +247,27 @@ class GuyInputComponent(InputComponent):
     """
 
 
-    left_pressed: bool = False
-    right_pressed: bool = False
-    jump_pressed: bool = False
-    jump_pressed_now: bool = False
+    buttons: int = 0
 
     keymap: dict = field(default_factory=lambda: dict(
         left=pyxel.KEY_LEFT,
         right=pyxel.KEY_RIGHT,
-        jump=pyxel.KEY_CONTROL,
+        jump=pyxel.KEY_SUPER if sys.platform == "darwin" else pyxel.KEY_CONTROL,
     ))
 
     jump_frame: int = 0
-    _jump_state: str = 'falling'
+    _jump_state: int = FALLING
+
+    # the keymap is read only once, so it shouldn't change afterwards
+    _left_key: int = field(init=False, repr=False)
+    _right_key: int = field(init=False, repr=False)
+    _jump_key: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        keymap = self.keymap
+        self._left_key = keymap['left']
+        self._right_key = keymap['right']
+        self._jump_key = keymap['jump']
 
     @property
     def jump_state(self):
@@ -217,66 +275,77 @@ class GuyInputComponent(InputComponent):
 
     @jump_state.setter
     def jump_state(self, value):
-        print("{:10} -> {:10}  {:>3} {:>3} {:>3}".format(
-            self._jump_state, value, self.y, self.velocity.y, self.jump_frame))
+        if DEBUG:
+            print("{:10} -> {:10}  {:>3} {:>3} {:>3}".format(
+                JUMP_STATE_NAMES[self._jump_state], JUMP_STATE_NAMES[value],
+                self.y, self.vy, self.jump_frame))
         self._jump_state = value
 
-    def _jump_state_machine(self):
-
-        if self.jump_state == 'standing':
-            self.velocity.y = 0
-            if not self.had_collision:
-                self.jump_state = 'falling'
-                return
-
-            if self.jump_pressed_now:
-                self.jump_state = 'jumping'
-                self.had_collision = False
-                return self._jump_state_machine()
-
-        elif self.jump_state == 'jumping':
-
-            if self.had_collision:
+    def _jump_standing(self):
+        self.vy = 0
+        if not self.had_collision:
+            self.jump_state = FALLING
+            return
+
+        if self.buttons & JUMP_NOW:
+            self.jump_state = JUMPING
+            self.had_collision = False
+            # start jumping this frame
+            return True
+
+    def _jump_jumping(self):
+        if self.had_collision:
+            self.jump_frame = 0
+            self.jump_state = FALLING
+            return
+
+        if self.buttons & JUMP:
+            self.vy = JUMP_VELOCITY
+            self.jump_frame += 1
+            if self.jump_frame > MAX_JUMP_FRAME:
                 self.jump_frame = 0
-                self.jump_state = 'falling'
-                return
-
-            if self.jump_pressed:
-                self.velocity.y = JUMP_VELOCITY
-                self.jump_frame += 1
-                if self.jump_frame > MAX_JUMP_FRAME:
-                    self.jump_frame = 0
-                    self.jump_state = 'falling'
+                self.jump_state = FALLING
 
-        elif self.jump_state == 'falling':
-            if self.had_collision:
-                self.jump_state = 'standing'
-                return
+    def _jump_falling(self):
+        if self.had_collision:
+            self.jump_state = STANDING
+            return
 
-        else:
-            assert False, "invalid state: %s" % self.jump_state
+    # indexed by state; a handler returns true to run the (new) state's
+    # handler again in the same frame
+    _jump_state_handlers = (_jump_standing, _jump_jumping, _jump_falling)
 
-    def process_input(self):
-        self.left_pressed = pyxel.btn(self.keymap['left'])
-        self.right_pressed = pyxel.btn(self.keymap['right'])
-        self.jump_pressed = pyxel.btn(self.keymap['jump'])
-        self.jump_pressed_now = pyxel.btnp(self.keymap['jump'])
-
-        if self.left_pressed + self.right_pressed == 1:
-            if self.left_pressed:
-                self.velocity.x = -HORIZONTAL_VELOCITY
-            if self.right_pressed:
-                self.velocity.x = +HORIZONTAL_VELOCITY
-        else:
-            self.velocity.x = 0
+    def _jump_state_machine(self):
+        handlers = self._jump_state_handlers
+        while True:
+            state = self.jump_state
+            # a negative index would silently run the wrong handler
+            assert 0 <= state < len(handlers), "invalid state: %s" % state
+            if not handlers[state](self):
+                break
+
+    # the pyxel functions are bound at definition time (here and in
+    # GuyGraphicsComponent.render()), to avoid module lookups every call
+    def process_input(self, _btn=pyxel.btn, _btnp=pyxel.btnp):
+        jump_key = self._jump_key
+        self.buttons = buttons = (
+            (LEFT if _btn(self._left_key) else 0)
+            | (RIGHT if _btn(self._right_key) else 0)
+            | (JUMP if _btn(jump_key) else 0)
+            | (JUMP_NOW if _btnp(jump_key) else 0)
+        )
+
+        self.vx = HORIZONTAL_VELOCITIES[buttons & (LEFT | RIGHT)]
 
         self._jump_state_machine()
 
 
 HORIZONTAL_VELOCITY = 1.2
+# indexed by buttons & (LEFT | RIGHT); neither or both means standing still
+HORIZONTAL_VELOCITIES = (0, -HORIZONTAL_VELOCITY, +HORIZONTAL_VELOCITY, 0)
 MAX_JUMP_FRAME = 5
 JUMP_VELOCITY = -3.6
-GRAVITY = Vec2(0, .5)
+GRAVITY_X, GRAVITY_Y = 0, .5
 
 
 @dataclass
@@ -284,16 +353,28 @@ class GuyGraphicsComponent(GraphicsComponent):
 
     color: int = 2
 
-    def render(self, offset_x, offset_y):
-        pyxel.rectb(round(offset_x + self.x),
-                    round(offset_y + self.y),
-                    round(self.w),
-                    round(self.h),
-                    self.color)
+    # the size doesn't change, so it's rounded only once
+    _draw_w: int = field(init=False, repr=False)
+    _draw_h: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._draw_w = round(self.w)
+        self._draw_h = round(self.h)
+
+    def render(self, offset_x, offset_y, _rectb=pyxel.rectb):
+        _rectb(round(offset_x + self.x),
+               round(offset_y + self.y),
+               self._draw_w,
+               self._draw_h,
+               self.color)
 
 
 @dataclass
-class Guy(GuyInputComponent, GuyGraphicsComponent, PhysicsComponent, Dynamic): pass
+class Guy(GuyInputComponent, GuyGraphicsComponent, PhysicsComponent, Dynamic):
+
+    def __post_init__(self):
+        GuyInputComponent.__post_init__(self)
+        GuyGraphicsComponent.__post_init__(self)
 
 
 def update():
@@ -309,7 +390,7 @@ def update():
 
     update_entities()
 
-    for entity in filter_entities(ENTITIES, InputComponent):
+    for entity in AGENTS:
         entity.process_input()
 
     WORLD.simulate()
@@ -325,67 +406,88 @@ def center_on_map():
 
 
 
-CENTER_FUNC_ITER = itertools.cycle([center_on_map, center_on_guy])
+CENTER_FUNCS = (center_on_map, center_on_guy)
+CENTER_FUNC_INDEX = 0
 
 def cycle_camera():
-    global CENTER_FUNC
-    CENTER_FUNC = next(CENTER_FUNC_ITER)
-
-CENTER_FUNC = None
-cycle_camera()
+    global CENTER_FUNC_INDEX
+    CENTER_FUNC_INDEX = (CENTER_FUNC_INDEX + 1) % len(CENTER_FUNCS)
 
 
 def draw():
     pyxel.cls(0)
-    offset_x, offset_y = CENTER_FUNC()
-    for entity in filter_entities(ENTITIES, GraphicsComponent):
+    offset_x, offset_y = CENTER_FUNCS[CENTER_FUNC_INDEX]()
+    for entity in ENTITIES:
         entity.render(offset_x, offset_y)
 
 
-def filter_entities(entities, *classinfos):
-    for entity in entities:
-        if all(isinstance(entity, ci) for ci in classinfos):
-            yield entity
-
-
 pyxel.init(SCREEN_W, SCREEN_H)
 
 GUY = Guy(x=MAP_LIST.current.spawn_points[0][0], y=MAP_LIST.current.spawn_points[0][1], w=3, h=7)
-if sys.platform == "darwin":
-    GUY.keymap['jump'] = pyxel.KEY_SUPER
 
 TWO = Guy(x=MAP_LIST.current.spawn_points[1][0], y=MAP_LIST.current.spawn_points[1][1], w=3, h=7,
           color=3,
           keymap=dict(left=pyxel.KEY_A, right=pyxel.KEY_D, jump=pyxel.KEY_SPACE))
 
 
+# the entities that move and take input; kept apart from the tiles
+AGENTS = [GUY]
+
+SHADOW_MAPS = {}
+
+def get_shadow_map(map, color, image):
+    # shadow maps are drawn like any other map, in their own image bank;
+    # they're made only once per map, so toggling them doesn't copy tiles
+    key = id(map), color, image
+    if key not in SHADOW_MAPS:
+        SHADOW_MAPS[key] = Map(
+            [t.to_shadow_tile(fill=False, color=color) for t in map.tiles],
+            w=map.w, h=map.h, image=image,
+        )
+    return SHADOW_MAPS[key]
+
+
+# the graphics entities, in drawing order; input goes through AGENTS,
+# and physics through WORLD
 ENTITIES = None
+ENTITIES_KEY = None
 WORLD = None
+WORLD_MAP = None
 
 def update_entities():
-    global ENTITIES, WORLD
-    ENTITIES = []
+    global ENTITIES, ENTITIES_KEY, WORLD, WORLD_MAP
 
     # TODO: we shouldn't process input here
-    # TODO: avoid copying tiles needlessly (a real ECS wouldn't?)
-    if pyxel.btn(pyxel.KEY_Z):
-        if MAP_LIST.previous:
-            ENTITIES.extend(
-                t.to_shadow_tile(fill=False, color=5)
-                for t in MAP_LIST.previous.tiles
-            )
-
-    ENTITIES.extend(MAP_LIST.current.tiles)
-    ENTITIES.append(GUY)
-
-    if pyxel.btn(pyxel.KEY_X):
-        if MAP_LIST.next:
-            ENTITIES.extend(
-                t.to_shadow_tile(fill=False, color=7)
-                for t in MAP_LIST.next.tiles
-            )
-
-    WORLD = World(filter_entities(ENTITIES, PhysicsComponent), GRAVITY)
+    show_previous = pyxel.btn(pyxel.KEY_Z)
+    show_next = pyxel.btn(pyxel.KEY_X)
+
+    # the entities only change when the current map
+    # or the shadow maps shown do, so most frames there's nothing to do
+    key = (MAP_LIST.current_index, bool(show_previous), bool(show_next))
+    if key != ENTITIES_KEY:
+        ENTITIES_KEY = key
+        ENTITIES = []
+
+        if show_previous:
+            if MAP_LIST.previous:
+                ENTITIES.append(get_shadow_map(MAP_LIST.previous, 5, image=1))
+
+        # the map renders its own tiles
+        ENTITIES.append(MAP_LIST.current)
+        ENTITIES.extend(AGENTS)
+
+        if show_next:
+            if MAP_LIST.next:
+                ENTITIES.append(get_shadow_map(MAP_LIST.next, 7, image=2))
+
+    # shadow tiles aren't physical, so the world (and its collision grid)
+    # only needs to be rebuilt when the current map changes
+    if WORLD_MAP is not MAP_LIST.current:
+        WORLD = World(
+            MAP_LIST.current.tiles + AGENTS,
+            GRAVITY_X, GRAVITY_Y,
+        )
+        WORLD_MAP = MAP_LIST.current
 
 update_entities()
 